@@ -1,14 +1,13 @@
 import asyncio
-import csv
 import logging
 import os
-import re
 import sqlite3
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import closing
 from datetime import datetime
 
+import aiosqlite
 from dotenv import load_dotenv
 
 from aiogram import Bot, Dispatcher, F
@@ -51,131 +50,275 @@ dp = Dispatcher()
 
 # Will be set on startup
 BOT_USERNAME: str | None = None
+NOTICE_TEXT: str = ""  # group notice for users with closed DMs; needs BOT_USERNAME
 
 # =========================================================
 # DB LAYER
 # =========================================================
 DB_PATH = "gatekeeper.db"
-SCHEMA_SQL = """
+# UTC timestamp rendered by SQLite itself, ISO-8601 with milliseconds
+NOW_SQL = "strftime('%Y-%m-%dT%H:%M:%f','now')"
+SCHEMA_SQL = f"""
 CREATE TABLE IF NOT EXISTS profiles (
     user_id    INTEGER PRIMARY KEY,
     first_name TEXT NOT NULL,
     last_name  TEXT NOT NULL,
     school_cls TEXT NOT NULL,
     email      TEXT,                 -- nullable for legacy rows; new inserts must provide valid fizmat email
-    created_at TEXT NOT NULL
+    created_at TEXT NOT NULL DEFAULT ({NOW_SQL})
 );
 
 CREATE TABLE IF NOT EXISTS pending (
     user_id INTEGER NOT NULL,
     chat_id INTEGER NOT NULL,
-    created_at TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT ({NOW_SQL}),
     PRIMARY KEY (user_id, chat_id)
 );
 """
 
-def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Bump when SCHEMA_SQL or the upgrade steps change; stored in PRAGMA user_version
+SCHEMA_VERSION = 3
 
+PRAGMA_SQL = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-64000;
+PRAGMA busy_timeout=5000;
+"""
+
+# Single shared connection, opened in on_startup
+DB: aiosqlite.Connection | None = None
+# Serializes write sections on DB so one caller's commit can't land another's half-done transaction.
+# Reads on the shared connection would see uncommitted rows too, so reads that act on
+# profiles (is_registered fallback, get_profile_row) take it as well; /export uses its own connection.
+DB_WRITE_LOCK = asyncio.Lock()
+
+
+# In-process cache of registered user ids (filled on startup)
+REGISTERED: set[int] = set()
+
+
+async def open_db():
+    global DB
+    DB = await aiosqlite.connect(DB_PATH)
+    DB.row_factory = aiosqlite.Row
+    # Connection-scoped tuning; WAL lets reads proceed during writes
+    await DB.executescript(PRAGMA_SQL)
+
+
+async def close_db():
+    global DB
+    if DB is not None:
+        await DB.close()
+        DB = None
 
-def ensure_schema_upgrade():
+
+async def ensure_schema_upgrade():
     """Ensure base schema exists and email uniqueness is indexed."""
-    with closing(db()) as conn:
-        conn.executescript(SCHEMA_SQL)
-        conn.commit()
+    async with DB.execute("PRAGMA user_version") as cur:
+        version = (await cur.fetchone())[0]
+    if version >= SCHEMA_VERSION:
+        return
 
-        cols = conn.execute("PRAGMA table_info(profiles)").fetchall()
-        col_names = {c[1] if isinstance(c, tuple) else c["name"] for c in cols}
-        if "email" not in col_names:
-            conn.execute("ALTER TABLE profiles ADD COLUMN email TEXT")
-            conn.commit()
+    await DB.executescript(SCHEMA_SQL)
+    await DB.commit()
 
-        # Unique index on email (SQLite allows multiple NULLs)
-        try:
-            conn.execute(
-                "CREATE UNIQUE INDEX IF NOT EXISTS idx_profiles_email_unique ON profiles(email)"
-            )
-            conn.commit()
-        except Exception as e:
-            logging.warning(f"Index creation warning: {e}")
+    async with DB.execute("PRAGMA table_info(profiles)") as cur:
+        cols = await cur.fetchall()
+    col_names = {c["name"] for c in cols}
+    if "email" not in col_names:
+        await DB.execute("ALTER TABLE profiles ADD COLUMN email TEXT")
+        await DB.commit()
 
+    # Unique index on email (SQLite allows multiple NULLs)
+    upgraded = True
+    try:
+        await DB.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_profiles_email_unique ON profiles(email)"
+        )
+        await DB.commit()
+    except Exception as e:
+        logging.warning(f"Index creation warning: {e}")
+        upgraded = False
+
+    # Lets consume_pending seek the newest row per user without a sort step; scanned
+    # backwards, the ascending index also yields the rowid tiebreaker in order
+    await DB.execute("DROP INDEX IF EXISTS idx_pending_user_created")
+    await DB.execute(
+        "CREATE INDEX IF NOT EXISTS idx_pending_user_created ON pending(user_id, created_at)"
+    )
+    # Leave user_version behind on a failed step so the next start retries it
+    if upgraded:
+        await DB.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    await DB.commit()
 
-def init_db():
-    ensure_schema_upgrade()
 
+async def init_db():
+    await open_db()
+    await ensure_schema_upgrade()
+    await load_registered()
 
-def is_registered(user_id: int) -> bool:
-    with closing(db()) as conn:
-        cur = conn.execute("SELECT 1 FROM profiles WHERE user_id=?", (user_id,))
-        return cur.fetchone() is not None
 
+async def load_registered():
+    async with DB.execute("SELECT user_id FROM profiles") as cur:
+        rows = await cur.fetchall()
+    REGISTERED.update(r["user_id"] for r in rows)
 
-def save_profile(user_id: int, first_name: str, last_name: str, school_cls: str, email: str):
+
+async def is_registered(user_id: int) -> bool:
+    if user_id in REGISTERED:
+        return True
+    # Under the write lock so an uncommitted save_profile upsert on the shared
+    # connection can't be seen (and cached) before it commits
+    async with DB_WRITE_LOCK:
+        async with DB.execute("SELECT 1 FROM profiles WHERE user_id=?", (user_id,)) as cur:
+            found = await cur.fetchone() is not None
+    if found:
+        REGISTERED.add(user_id)
+    return found
+
+
+async def save_profile(user_id: int, first_name: str, last_name: str, school_cls: str, email: str):
+    """Upsert the profile and consume its pending chat in one transaction; returns that chat_id."""
     # Normalize email and enforce domain
     email_norm = (email or "").strip().lower()
     if not is_valid_fizmat_email(email_norm):
         raise ValueError("Invalid email (must be @fizmat.kz).")
 
-    with closing(db()) as conn:
-        conn.execute(
-            """
-            INSERT INTO profiles (user_id, first_name, last_name, school_cls, email, created_at)
-            VALUES (?,?,?,?,?,?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                first_name=excluded.first_name,
-                last_name=excluded.last_name,
-                school_cls=excluded.school_cls,
-                email=excluded.email,
-                created_at=excluded.created_at
-            """,
-            (
-                user_id,
-                (first_name or "").strip(),
-                (last_name or "").strip(),
-                (school_cls or "").strip(),
-                email_norm,
-                datetime.utcnow().isoformat(),
-            ),
-        )
-        conn.commit()
+    async with DB_WRITE_LOCK:
+        # Make sure buffered rows for this user are visible to the pending lookup
+        await _flush_pending()
+        try:
+            # created_at is stamped by SQLite; spelled out since legacy tables have no column default
+            await DB.execute(
+                f"""
+                INSERT INTO profiles (user_id, first_name, last_name, school_cls, email, created_at)
+                VALUES (?,?,?,?,?,{NOW_SQL})
+                ON CONFLICT(user_id) DO UPDATE SET
+                    first_name=excluded.first_name,
+                    last_name=excluded.last_name,
+                    school_cls=excluded.school_cls,
+                    email=excluded.email,
+                    created_at=excluded.created_at
+                """,
+                (
+                    user_id,
+                    (first_name or "").strip(),
+                    (last_name or "").strip(),
+                    (school_cls or "").strip(),
+                    email_norm,
+                ),
+            )
+            chat_id = await _take_pending(user_id)
+            await DB.commit()
+        except BaseException:
+            await DB.rollback()
+            raise
+    REGISTERED.add(user_id)
+    return chat_id
+
+
+# Pending inserts are buffered and written in one transaction per tick
+PENDING_BUF: deque[tuple[int, int]] = deque()
+PENDING_FLUSH_INTERVAL = 0.1  # seconds
+
+# user_id -> (chat_id, ts) of the user's newest committed pending row. A repeat for
+# that same chat within the TTL skips the write; any other chat is written so it
+# becomes the newest row, as consume_pending expects.
+PENDING_RECENT: dict[int, tuple[int, float]] = {}
+PENDING_RECENT_TTL = 300  # seconds
+PENDING_RECENT_MAX = 10000
 
 
 def add_pending(user_id: int, chat_id: int):
-    with closing(db()) as conn:
-        conn.execute(
-            "REPLACE INTO pending (user_id, chat_id, created_at) VALUES (?,?,?)",
-            (user_id, chat_id, datetime.utcnow().isoformat()),
-        )
-        conn.commit()
+    recent = PENDING_RECENT.get(user_id)
+    if recent and recent[0] == chat_id and time.time() - recent[1] < PENDING_RECENT_TTL:
+        return
+    PENDING_BUF.append((user_id, chat_id))
+
 
+async def flush_pending():
+    async with DB_WRITE_LOCK:
+        await _flush_pending()
 
-def consume_pending(user_id: int):
-    with closing(db()) as conn:
-        cur = conn.execute(
-            "SELECT chat_id FROM pending WHERE user_id=? ORDER BY created_at DESC LIMIT 1",
-            (user_id,),
+
+async def _flush_pending():
+    # Caller holds DB_WRITE_LOCK
+    if not PENDING_BUF:
+        return
+    batch = [PENDING_BUF.popleft() for _ in range(len(PENDING_BUF))]
+    try:
+        await DB.executemany(
+            f"REPLACE INTO pending (user_id, chat_id, created_at) VALUES (?,?,{NOW_SQL})",
+            batch,
         )
-        row = cur.fetchone()
-        if not row:
-            return None
-        chat_id = row[0] if isinstance(row, tuple) else row["chat_id"]
-        conn.execute("DELETE FROM pending WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-        conn.commit()
-        return chat_id
+        await DB.commit()
+    except BaseException:
+        # Keep the rows (also on cancellation) for the next flush, ahead of anything buffered meanwhile
+        PENDING_BUF.extendleft(reversed(batch))
+        await DB.rollback()
+        raise
+    if len(PENDING_RECENT) >= PENDING_RECENT_MAX:
+        PENDING_RECENT.clear()
+    now = time.time()
+    for user_id, chat_id in batch:
+        PENDING_RECENT[user_id] = (chat_id, now)
+
+
+async def pending_flusher():
+    while True:
+        await asyncio.sleep(PENDING_FLUSH_INTERVAL)
+        try:
+            await flush_pending()
+        except Exception as e:
+            logging.warning(f"pending flush failed: {e}")
+
+
+async def _take_pending(user_id: int):
+    # Select + delete the newest pending row; the caller holds DB_WRITE_LOCK and commits
+    async with DB.execute(
+        "SELECT chat_id FROM pending WHERE user_id=? ORDER BY created_at DESC, rowid DESC LIMIT 1",
+        (user_id,),
+    ) as cur:
+        row = await cur.fetchone()
+    if not row:
+        return None
+    chat_id = row["chat_id"]
+    await DB.execute("DELETE FROM pending WHERE user_id=? AND chat_id=?", (user_id, chat_id))
+    PENDING_RECENT.pop(user_id, None)
+    return chat_id
+
+
+async def consume_pending(user_id: int):
+    async with DB_WRITE_LOCK:
+        # Make sure buffered rows for this user are visible to the SELECT
+        await _flush_pending()
+        try:
+            chat_id = await _take_pending(user_id)
+            if chat_id is not None:
+                await DB.commit()
+        except BaseException:
+            await DB.rollback()
+            raise
+    return chat_id
 
 
 # =========================================================
 # EMAIL VALIDATION (@fizmat.kz only)
 # =========================================================
-FIZMAT_EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+-]+@fizmat\.kz$", re.IGNORECASE)
+FIZMAT_DOMAIN = "@fizmat.kz"
+EMAIL_LOCAL_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789._%+-")
 
 
 def is_valid_fizmat_email(email: str) -> bool:
     if not email:
         return False
-    return bool(FIZMAT_EMAIL_RE.fullmatch(email.strip().lower()))
+    e = email.strip().lower()
+    if not e.endswith(FIZMAT_DOMAIN):
+        return False
+    local = e[:-len(FIZMAT_DOMAIN)]
+    return bool(local) and all(c in EMAIL_LOCAL_CHARS for c in local)
 
 
 # =========================================================
@@ -189,38 +332,46 @@ class Reg(StatesGroup):
     confirm = State()
 
 
+CONFIRM_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm")],
+        [InlineKeyboardButton(text="✏️ Изменить имя", callback_data="edit_first")],
+        [InlineKeyboardButton(text="✏️ Изменить фамилию", callback_data="edit_last")],
+        [InlineKeyboardButton(text="✏️ Изменить класс", callback_data="edit_cls")],
+        [InlineKeyboardButton(text="✏️ Изменить почту", callback_data="edit_email")],
+    ]
+)
+
+
 # =========================================================
 # PERMISSIONS
 # =========================================================
 
-def locked_perms() -> ChatPermissions:
-    return ChatPermissions(
-        can_send_messages=False,
-        can_send_audios=False,
-        can_send_documents=False,
-        can_send_photos=False,
-        can_send_videos=False,
-        can_send_video_notes=False,
-        can_send_voice_notes=False,
-        can_send_polls=False,
-        can_send_other_messages=False,
-        can_add_web_page_previews=False,
-    )
-
+LOCKED_PERMS = ChatPermissions(
+    can_send_messages=False,
+    can_send_audios=False,
+    can_send_documents=False,
+    can_send_photos=False,
+    can_send_videos=False,
+    can_send_video_notes=False,
+    can_send_voice_notes=False,
+    can_send_polls=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False,
+)
 
-def open_perms() -> ChatPermissions:
-    return ChatPermissions(
-        can_send_messages=True,
-        can_send_audios=True,
-        can_send_documents=True,
-        can_send_photos=True,
-        can_send_videos=True,
-        can_send_video_notes=True,
-        can_send_voice_notes=True,
-        can_send_polls=True,
-        can_send_other_messages=True,
-        can_add_web_page_previews=True,
-    )
+OPEN_PERMS = ChatPermissions(
+    can_send_messages=True,
+    can_send_audios=True,
+    can_send_documents=True,
+    can_send_photos=True,
+    can_send_videos=True,
+    can_send_video_notes=True,
+    can_send_voice_notes=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+)
 
 
 # =========================================================
@@ -238,15 +389,65 @@ async def send_ephemeral_group_notice(chat_id: int, text: str, ttl: int = 10):
         pass
 
 
+async def lock_member(chat_id: int, user_id: int, context: str = "restrict"):
+    try:
+        await bot.restrict_chat_member(chat_id, user_id, permissions=LOCKED_PERMS)
+    except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound) as e:
+        logging.warning(f"{context} failed: {e}")
+
+
+async def delete_quietly(message: Message):
+    try:
+        await message.delete()
+    except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound):
+        pass
+
+
+LINK_CACHE: dict[int, str] = {}  # chat_id -> verify deep link
+
+
+async def get_verify_link(chat_id: int) -> str | None:
+    link = LINK_CACHE.get(chat_id)
+    if link is None:
+        try:
+            link = await create_start_link(bot, payload=f"verify_{chat_id}")
+        except Exception:
+            return None
+        LINK_CACHE[chat_id] = link
+    return link
+
+
+DM_TEXT_BASE = (
+    "Привет! Чтобы получить доступ к сообщениям в чате, заполните короткую анкету "
+    "(Имя, Фамилия, Класс и школьную почту @fizmat.kz)."
+)
+
+
+def build_dm_text(link: str | None) -> str:
+    if link:
+        return f"{DM_TEXT_BASE}\nОткройте форму по ссылке: {link}"
+    return f"{DM_TEXT_BASE}\nОткройте личку с ботом и нажмите /start."
+
+
+ADMIN_CACHE: dict[tuple[int, int], tuple[bool, float]] = {}  # (chat_id, user_id) -> (is_admin, expires_at)
+ADMIN_CACHE_TTL = 60  # seconds
+
+
 async def is_admin(chat_id: int, user_id: int) -> bool:
+    now = time.time()
+    cached = ADMIN_CACHE.get((chat_id, user_id))
+    if cached and cached[1] > now:
+        return cached[0]
     try:
         m = await bot.get_chat_member(chat_id, user_id)
-        status = getattr(m, "status", None)
-        if hasattr(status, "value"):
-            status = status.value
-        return status in ("creator", "administrator")
     except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound):
         return False
+    status = getattr(m, "status", None)
+    if hasattr(status, "value"):
+        status = status.value
+    result = status in ("creator", "administrator")
+    ADMIN_CACHE[(chat_id, user_id)] = (result, now + ADMIN_CACHE_TTL)
+    return result
 
 
 # =========================================================
@@ -256,20 +457,72 @@ NEED_DM_CACHE: dict[int, set[int]] = defaultdict(set)  # chat_id -> set(user_id)
 LAST_NOTICE_AT: dict[int, float] = {}                 # chat_id -> ts
 NOTICE_COOLDOWN = 60  # seconds; at most once per minute
 BATCH_THRESHOLD = 20  # if many users accumulate, notify earlier
+NOTICE_STATE_TTL = 3600  # seconds; forget chats idle for longer than this
+STATE_SWEEP_INTERVAL = 600  # seconds
+
+
+async def state_sweeper():
+    # Expires idle notice state plus stale ADMIN_CACHE / PENDING_RECENT entries
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        now = time.time()
+        cutoff = now - NOTICE_STATE_TTL
+        for chat_id, ts in list(LAST_NOTICE_AT.items()):
+            if ts < cutoff:
+                del LAST_NOTICE_AT[chat_id]
+                NEED_DM_CACHE.pop(chat_id, None)
+        for key, (_, expires_at) in list(ADMIN_CACHE.items()):
+            if expires_at <= now:
+                del ADMIN_CACHE[key]
+        for user_id, (_, ts) in list(PENDING_RECENT.items()):
+            if now - ts >= PENDING_RECENT_TTL:
+                del PENDING_RECENT[user_id]
 
 
 # =========================================================
 # STARTUP
 # =========================================================
+BACKGROUND_TASKS: list[asyncio.Task] = []
+
+
+async def stop_background_tasks():
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    # Let an in-flight flush finish before the final flush and close
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+
+
 @dp.startup()
 async def on_startup():
-    init_db()
+    # Talk to Telegram before opening the DB, so a bad token leaves nothing to clean up
     me = await bot.get_me()
-    global BOT_USERNAME
+    global BOT_USERNAME, NOTICE_TEXT
     BOT_USERNAME = me.username
+    NOTICE_TEXT = (
+        "⚠️ Некоторые участники не могут получить доступ в чат, т.к. у них закрыты ЛС с ботом.\n"
+        f"Откройте личные сообщения и напишите боту @{BOT_USERNAME}, затем нажмите /start, чтобы пройти подтверждение."
+    )
+    try:
+        await init_db()
+        BACKGROUND_TASKS.append(asyncio.create_task(pending_flusher()))
+        BACKGROUND_TASKS.append(asyncio.create_task(state_sweeper()))
+    except BaseException:
+        # aiogram skips shutdown handlers when startup fails; the aiosqlite
+        # worker thread would otherwise keep the process alive
+        await stop_background_tasks()
+        await close_db()
+        raise
     logging.info(f"Bot started as @{me.username}")
 
 
+@dp.shutdown()
+async def on_shutdown():
+    await stop_background_tasks()
+    await flush_pending()
+    await close_db()
+
+
 # =========================================================
 # GROUP HANDLERS (QUIET)
 # =========================================================
@@ -282,26 +535,17 @@ async def on_user_join(event: ChatMemberUpdated):
     if user.is_bot:
         return
 
-    if not is_registered(user.id):
-        try:
-            await bot.restrict_chat_member(chat.id, user.id, permissions=locked_perms())
-        except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound) as e:
-            logging.warning(f"restrict failed: {e}")
+    if not await is_registered(user.id):
         add_pending(user.id, chat.id)
 
-        # Quiet: try DM only (no group post)
-        try:
-            link = await create_start_link(bot, payload=f"verify_{chat.id}")
-        except Exception:
-            link = None
-
-        dm_text = (
-            "Привет! Чтобы получить доступ к сообщениям в чате, заполните короткую анкету "
-            "(Имя, Фамилия, Класс и школьную почту @fizmat.kz)."
-            + (f"\nОткройте форму по ссылке: {link}" if link else "\nОткройте личку с ботом и нажмите /start.")
+        # Restrict and build the DM link concurrently; quiet: DM only (no group post)
+        _, link = await asyncio.gather(
+            lock_member(chat.id, user.id),
+            get_verify_link(chat.id),
         )
+
         try:
-            await bot.send_message(user.id, dm_text)
+            await bot.send_message(user.id, build_dm_text(link))
         except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound):
             # Do nothing here; guard_group_messages will batch-notify if needed
             pass
@@ -315,34 +559,21 @@ async def guard_group_messages(message: Message):
     user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if is_registered(user_id):
+    if await is_registered(user_id):
         return
 
     add_pending(user_id, chat_id)
-    try:
-        await bot.restrict_chat_member(chat_id, user_id, permissions=locked_perms())
-    except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound) as e:
-        logging.warning(f"restrict (on message) failed: {e}")
 
-    # Delete unregistered user's message
-    try:
-        await message.delete()
-    except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound):
-        pass
+    # Restrict, delete the unregistered user's message and build the DM link concurrently
+    _, _, link = await asyncio.gather(
+        lock_member(chat_id, user_id, "restrict (on message)"),
+        delete_quietly(message),
+        get_verify_link(chat_id),
+    )
 
     # Try DM only (quiet mode)
     try:
-        link = await create_start_link(bot, payload=f"verify_{chat_id}")
-    except Exception:
-        link = None
-
-    dm_text = (
-        "Привет! Чтобы получить доступ к сообщениям в чате, заполните короткую анкету "
-        "(Имя, Фамилия, Класс и школьную почту @fizmat.kz)."
-        + (f"\nОткройте форму по ссылке: {link}" if link else "\nОткройте личку с ботом и нажмите /start.")
-    )
-    try:
-        await bot.send_message(user_id, dm_text)
+        await bot.send_message(user_id, build_dm_text(link))
         return
     except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound):
         # DM closed — batch a single group notice with throttling
@@ -352,12 +583,8 @@ async def guard_group_messages(message: Message):
         if (now - last) >= NOTICE_COOLDOWN or len(NEED_DM_CACHE[chat_id]) >= BATCH_THRESHOLD:
             LAST_NOTICE_AT[chat_id] = now
             NEED_DM_CACHE[chat_id].clear()
-            notice = (
-                "⚠️ Некоторые участники не могут получить доступ в чат, т.к. у них закрыты ЛС с ботом.\n"
-                f"Откройте личные сообщения и напишите боту @{BOT_USERNAME}, затем нажмите /start, чтобы пройти подтверждение."
-            )
             try:
-                await bot.send_message(chat_id, notice)
+                await bot.send_message(chat_id, NOTICE_TEXT)
             except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound):
                 pass
 
@@ -370,8 +597,8 @@ async def start(message: Message, state: FSMContext):
     args = (message.text or "").split(maxsplit=1)
     payload = args[1] if len(args) > 1 else ""
 
-    if is_registered(message.from_user.id):
-        chat_id = consume_pending(message.from_user.id)
+    if await is_registered(message.from_user.id):
+        chat_id = await consume_pending(message.from_user.id)
         text = "Вы уже зарегистрированы."
         if chat_id:
             await unlock_user_in_chat(chat_id, message.from_user.id)
@@ -427,16 +654,6 @@ async def reg_email(message: Message, state: FSMContext):
     await state.update_data(email=email)
     data = await state.get_data()
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm")],
-            [InlineKeyboardButton(text="✏️ Изменить имя", callback_data="edit_first")],
-            [InlineKeyboardButton(text="✏️ Изменить фамилию", callback_data="edit_last")],
-            [InlineKeyboardButton(text="✏️ Изменить класс", callback_data="edit_cls")],
-            [InlineKeyboardButton(text="✏️ Изменить почту", callback_data="edit_email")],
-        ]
-    )
-
     await state.set_state(Reg.confirm)
     await message.answer(
         "Проверьте данные:\n"
@@ -444,35 +661,23 @@ async def reg_email(message: Message, state: FSMContext):
         f"• Фамилия: <b>{data.get('last_name','')}</b>\n"
         f"• Класс: <b>{data.get('school_cls','')}</b>\n"
         f"• Почта: <b>{data.get('email','')}</b>",
-        reply_markup=kb,
+        reply_markup=CONFIRM_KB,
     )
 
 
-@dp.callback_query(Reg.confirm, F.data == "edit_first")
-async def edit_first(cb: CallbackQuery, state: FSMContext):
-    await cb.message.answer("Введите имя заново:")
-    await state.set_state(Reg.first_name)
-    await cb.answer()
-
-
-@dp.callback_query(Reg.confirm, F.data == "edit_last")
-async def edit_last(cb: CallbackQuery, state: FSMContext):
-    await cb.message.answer("Введите фамилию заново:")
-    await state.set_state(Reg.last_name)
-    await cb.answer()
-
-
-@dp.callback_query(Reg.confirm, F.data == "edit_cls")
-async def edit_cls(cb: CallbackQuery, state: FSMContext):
-    await cb.message.answer("Введите класс заново:")
-    await state.set_state(Reg.school_cls)
-    await cb.answer()
+EDIT_MAP = {
+    "edit_first": (Reg.first_name, "Введите имя заново:"),
+    "edit_last": (Reg.last_name, "Введите фамилию заново:"),
+    "edit_cls": (Reg.school_cls, "Введите класс заново:"),
+    "edit_email": (Reg.email, "Введите школьную почту заново (только @fizmat.kz):"),
+}
 
 
-@dp.callback_query(Reg.confirm, F.data == "edit_email")
-async def edit_email(cb: CallbackQuery, state: FSMContext):
-    await cb.message.answer("Введите школьную почту заново (только @fizmat.kz):")
-    await state.set_state(Reg.email)
+@dp.callback_query(Reg.confirm, F.data.in_(EDIT_MAP))
+async def edit_field(cb: CallbackQuery, state: FSMContext):
+    next_state, prompt = EDIT_MAP[cb.data]
+    await cb.message.answer(prompt)
+    await state.set_state(next_state)
     await cb.answer()
 
 
@@ -482,7 +687,7 @@ async def confirm(cb: CallbackQuery, state: FSMContext):
     uid = cb.from_user.id
 
     try:
-        save_profile(
+        chat_id = await save_profile(
             uid,
             data.get("first_name", ""),
             data.get("last_name", ""),
@@ -497,7 +702,6 @@ async def confirm(cb: CallbackQuery, state: FSMContext):
 
     await state.clear()
 
-    chat_id = consume_pending(uid)
     if chat_id:
         await unlock_user_in_chat(chat_id, uid)
         await cb.message.answer("Готово! Доступ в сообществе открыт. Можете писать сообщения.")
@@ -509,7 +713,7 @@ async def confirm(cb: CallbackQuery, state: FSMContext):
 
 async def unlock_user_in_chat(chat_id: int, user_id: int):
     try:
-        await bot.restrict_chat_member(chat_id, user_id, permissions=open_perms())
+        await bot.restrict_chat_member(chat_id, user_id, permissions=OPEN_PERMS)
         await bot.send_message(chat_id, f"✅ Пользователь <a href=\"tg://user?id={user_id}\">разрешён</a> к участию.")
     except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound) as e:
         logging.warning(f"unlock failed: {e}")
@@ -519,13 +723,12 @@ async def unlock_user_in_chat(chat_id: int, user_id: int):
 # ADMIN TOOLS: /who (PRIVATE), /remove (PRIVATE), /export, /setup_instructions
 # =========================================================
 
-def get_profile_row(user_id: int):
-    with closing(db()) as conn:
-        cur = conn.execute(
-            "SELECT user_id, first_name, last_name, school_cls, email, created_at FROM profiles WHERE user_id=?",
-            (user_id,),
-        )
-        return cur.fetchone()
+async def get_profile_row(user_id: int):
+    async with DB_WRITE_LOCK, DB.execute(
+        "SELECT user_id, first_name, last_name, school_cls, email, created_at FROM profiles WHERE user_id=?",
+        (user_id,),
+    ) as cur:
+        return await cur.fetchone()
 
 
 @dp.message(Command("who"), F.chat.type == ChatType.PRIVATE)
@@ -540,23 +743,17 @@ async def who_cmd_private(message: Message):
         return
 
     target_id = int(parts[1])
-    row = get_profile_row(target_id)
+    row = await get_profile_row(target_id)
 
     if row:
-        # row can be Row or tuple depending on row_factory; handle both
-        def _get(k, idx):
-            try:
-                return row[k]
-            except Exception:
-                return row[idx]
         text = (
             "<b>Профиль участника</b>\n"
-            f"ID: <code>{_get('user_id', 0)}</code>\n"
-            f"Имя: <b>{_get('first_name', 1)}</b>\n"
-            f"Фамилия: <b>{_get('last_name', 2)}</b>\n"
-            f"Класс: <b>{_get('school_cls', 3)}</b>\n"
-            f"Почта: <b>{_get('email', 4) or '—'}</b>\n"
-            f"Регистрация (UTC): {_get('created_at', 5)}\n"
+            f"ID: <code>{row['user_id']}</code>\n"
+            f"Имя: <b>{row['first_name']}</b>\n"
+            f"Фамилия: <b>{row['last_name']}</b>\n"
+            f"Класс: <b>{row['school_cls']}</b>\n"
+            f"Почта: <b>{row['email'] or '—'}</b>\n"
+            f"Регистрация (UTC): {row['created_at']}\n"
         )
     else:
         text = "<b>Профиль не найден</b> — пользователь ещё не регистрировался."
@@ -564,10 +761,15 @@ async def who_cmd_private(message: Message):
     await message.answer(text)
 
 
-def delete_profile(user_id: int):
-    with closing(db()) as conn:
-        conn.execute("DELETE FROM profiles WHERE user_id=?", (user_id,))
-        conn.commit()
+async def delete_profile(user_id: int):
+    async with DB_WRITE_LOCK:
+        try:
+            await DB.execute("DELETE FROM profiles WHERE user_id=?", (user_id,))
+            await DB.commit()
+        except BaseException:
+            await DB.rollback()
+            raise
+    REGISTERED.discard(user_id)
 
 
 @dp.message(Command("remove"), F.chat.type == ChatType.PRIVATE)
@@ -582,7 +784,7 @@ async def remove_cmd(message: Message):
         return
 
     target_id = int(parts[1])
-    delete_profile(target_id)
+    await delete_profile(target_id)
     await message.answer(f"✅ Пользователь {target_id} удалён из базы.")
 
 
@@ -596,6 +798,32 @@ async def info_cmd(message: Message):
     await message.answer(text)
 
 
+def _csv_field(col: str) -> str:
+    # SQL expression quoting a text column the way csv.writer does (QUOTE_MINIMAL)
+    return (
+        f"CASE WHEN instr({col}, ',') OR instr({col}, '\"') OR instr({col}, char(10)) OR instr({col}, char(13)) "
+        f"THEN '\"' || replace({col}, '\"', '\"\"') || '\"' ELSE {col} END"
+    )
+
+
+CSV_HEADER = "user_id,first_name,last_name,class,email,created_at_utc\r\n"
+CSV_SELECT = (
+    "SELECT user_id || ',' || "
+    + " || ',' || ".join(
+        _csv_field(c) for c in ("first_name", "last_name", "school_cls", "coalesce(email, '')", "created_at")
+    )
+    + " || char(13, 10) FROM profiles ORDER BY created_at"
+)
+
+
+def _dump_csv(path: str):
+    # Runs in a worker thread with its own read connection (WAL allows it
+    # alongside the shared one); SQLite renders each CSV line itself.
+    with closing(sqlite3.connect(DB_PATH)) as conn, open(path, "w", newline="", encoding="utf-8") as f:
+        f.write(CSV_HEADER)
+        f.writelines(r[0] for r in conn.execute(CSV_SELECT))
+
+
 @dp.message(Command("export"))
 async def export_csv(message: Message):
     # Allow in private; in groups — only admins
@@ -605,19 +833,7 @@ async def export_csv(message: Message):
             return
 
     path = f"profiles_{int(datetime.utcnow().timestamp())}.csv"
-    with closing(db()) as conn:
-        rows = conn.execute(
-            "SELECT user_id, first_name, last_name, school_cls, email, created_at FROM profiles ORDER BY created_at"
-        ).fetchall()
-
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["user_id", "first_name", "last_name", "class", "email", "created_at_utc"])
-        for r in rows:
-            if isinstance(r, sqlite3.Row):
-                writer.writerow([r["user_id"], r["first_name"], r["last_name"], r["school_cls"], r["email"] or "", r["created_at"]])
-            else:
-                writer.writerow([r[0], r[1], r[2], r[3], r[4] or "", r[5]])
+    await asyncio.to_thread(_dump_csv, path)
 
     try:
         await message.answer_document(document=path, caption="Экспорт анкет")
@@ -635,10 +851,7 @@ async def setup_instructions(message: Message):
         await send_ephemeral_group_notice(message.chat.id, "⛔ Только для администраторов.", ttl=8)
         return
 
-    try:
-        link = await create_start_link(bot, payload=f"verify_{message.chat.id}")
-    except Exception:
-        link = None
+    link = await get_verify_link(message.chat.id)
 
     text = (
         "🔒 Доступ в чат только после короткой регистрации в ЛС с ботом.\n"